@@ -1,7 +1,8 @@
 from __future__ import annotations
-from collections import deque
-from enum import Enum, auto
+import copy
 from abc import ABCMeta, abstractmethod
+from operator import add
+from typing import Callable
 import pypsg
 
 
@@ -36,11 +37,11 @@ class Sequencer:
             try:
                 self._title = bytes(title).decode("utf8").replace("\n", " ")
             except Exception:
-                raise Sequencer.FormatError
+                raise Sequencer.FormatError("header: invalid title")
             data_offset = offset
             self._patch_table_offset = data_reader.get_short(offset + 2) + data_offset
             if self._patch_table_offset >= data_reader.length:
-                raise Sequencer.FormatError
+                raise Sequencer.FormatError("header: patch table offset out of range")
             self._channel_offsets = [
                 self._adjust_part_offset(
                     data_offset,
@@ -68,7 +69,7 @@ class Sequencer:
                 return None
             adjusted = data_offset + part_offset
             if adjusted >= length:
-                raise Sequencer.FormatError
+                raise Sequencer.FormatError("header: part offset out of range")
             return adjusted
 
     class _Context:
@@ -87,6 +88,14 @@ class Sequencer:
             2022,
         ]
 
+        # note -> (tune, octave, tune >> octave) for all notes (0x80 - 0xDF).
+        _note_table = [
+            (tune, note // 12, min(tune >> (note // 12), 4095))
+            for (note, tune) in enumerate(_tune_table * 8)
+        ]
+
+        __slots__ = ('_sample_generator', '_data_reader', '_patch_table_offset')
+
         def __init__(
             self,
             sample_generator: pypsg.SampleGenerator,
@@ -123,8 +132,8 @@ class Sequencer:
                 else:
                     offset += 7
 
-        def get_tune_and_octave(self, note: int) -> tuple[int, int]:
-            return (self._tune_table[note % 12], note // 12)
+        def get_note(self, note: int) -> tuple[int, int, int]:
+            return self._note_table[note]
 
         def get_channel(self, channel_number: int) -> pypsg.SampleGenerator.ToneChannel:
             return self._sample_generator[channel_number]
@@ -134,6 +143,11 @@ class Sequencer:
 
     class Part:
         class _LFO:
+            __slots__ = (
+                '_is_enable', '_delay', '_speed', '_depth', '_value',
+                '_wait_count', '_depth_count', '_value_current', '_current',
+            )
+
             def __init__(self, is_enable=False, delay=0, speed=0, depth=0, value=0):
                 self._is_enable = is_enable
                 self._delay = delay
@@ -171,11 +185,13 @@ class Sequencer:
                 return self._current
 
         class _EnvelopeGenerator:
-            class Phase(Enum):
-                Attack = auto()
-                Decay = auto()
-                Sustain = auto()
-                Release = auto()
+            class Phase:
+                Attack = 0
+                Decay = 1
+                Sustain = 2
+                Release = 3
+
+            __slots__ = ('_current', '_al', '_ar', '_dr', '_sl', '_sr', '_rr', '_phase')
 
             def __init__(self):
                 self._current = 0
@@ -228,6 +244,8 @@ class Sequencer:
 
         class _RepeatStack:
             class Item:
+                __slots__ = ('_count', '_start_offset', '_end_offset')
+
                 def __init__(self, loop_count: int, start_offset: int):
                     self._count = loop_count
                     self._start_offset = start_offset
@@ -253,29 +271,43 @@ class Sequencer:
                     self._count -= 1
                     return self._count
 
+            # The innermost item is the last element (a list is much smaller than a deque).
+            __slots__ = ('__stack',)
+
             def __init__(self):
-                self.__deque = deque([self.Item])
+                self.__stack = [self.Item]
 
             def start(self, loopCount, offset):
-                self.__deque.appendleft(self.Item(loopCount, offset))
+                self.__stack.append(self.Item(loopCount, offset))
 
             def break_if_last(self, offset) -> int:
-                data = self.__deque[0]
+                data = self.__stack[-1]
                 if data.count == 1:
-                    self.__deque.popleft()
+                    self.__stack.pop()
                     offset = data.end
                 return offset
 
             def end(self, offset) -> tuple[int, bool]:
-                data = self.__deque[0]
+                data = self.__stack[-1]
                 is_infinite_loop = data.count == 0
                 if is_infinite_loop or data.countDown() != 0:
                     data.end = offset
                     offset = data.start
                 else:
-                    self.__deque.popleft()
+                    self.__stack.pop()
                 return (offset, is_infinite_loop)
 
+        # (envelope * volume) >> 8 for volume 0 - 16 (larger values are rejected by set_volume() anyway).
+        _volume_table = [
+            [(envelope * volume) >> 8 for envelope in range(256)] for volume in range(17)
+        ]
+
+        __slots__ = (
+            '_context', '_channel', '_next_offset', '_length_count', '_is_tie', '_octave', '_volume',
+            '_tune', '_note_tune', '_detune', '_envelope', '_repeat', '_lfo', '_infinite_loop_count',
+            '_channel_tune', '_channel_volume',
+        )
+
         def __init__(
             self, context: Sequencer._Context, channel_number: int, offset: int
         ):
@@ -287,6 +319,7 @@ class Sequencer:
             self._octave = 0
             self._volume = 0
             self._tune = 0
+            self._note_tune = 0
             self._detune = 0
             self._envelope = self._EnvelopeGenerator()
             self._repeat = self._RepeatStack()
@@ -294,6 +327,9 @@ class Sequencer:
             self._channel.set_tone_on(True)
             self._channel.set_noise_on(False)
             self._infinite_loop_count = 0
+            # The last values written to the channel (registers are written only when they change).
+            self._channel_tune = None
+            self._channel_volume = None
 
         def _next_byte(self) -> int:
             data = self._context.get_byte(self._next_offset)
@@ -313,14 +349,31 @@ class Sequencer:
                 self._apply_tune()
 
         def _apply_tune(self):
-            self._channel.set_tune(min(max((self._tune + self._lfo.current + self._detune) >> self._octave, 0), 4095))
+            offset = self._lfo.current + self._detune
+            tune = (
+                self._note_tune
+                if offset == 0
+                else min(max((self._tune + offset) >> self._octave, 0), 4095)
+            )
+            if tune != self._channel_tune:
+                self._channel_tune = tune
+                self._channel.set_tune(tune)
 
         def _update_volume(self):
             self._envelope.update()
             self._apply_volume()
 
         def _apply_volume(self):
-            self._channel.set_volume((self._envelope.current * self._volume) >> 8)
+            volume = self._volume
+            envelope = self._envelope.current
+            value = (
+                self._volume_table[volume][envelope]
+                if volume <= 16
+                else (envelope * volume) >> 8
+            )
+            if value != self._channel_volume:
+                self._channel_volume = value
+                self._channel.set_volume(value)
 
         def tick(self):
             self._update_tune()
@@ -339,7 +392,7 @@ class Sequencer:
                     self._length_count = data + 1
                     return True
                 elif data < 0xE0:
-                    (self._tune, self._octave) = self._context.get_tune_and_octave(
+                    (self._tune, self._octave, self._note_tune) = self._context.get_note(
                         data - 0x80
                     )
                     if not self._is_tie:
@@ -397,6 +450,7 @@ class Sequencer:
                     self._channel.set_tone_on((data & 0x1) != 0)
                     self._channel.set_noise_on((data & 0x2) != 0)
                 elif data == 0xFF:
+                    self._channel_volume = 0
                     self._channel.set_volume(0)
                     return False
 
@@ -404,6 +458,8 @@ class Sequencer:
         def infinite_loop_count(self) -> int:
             return self._infinite_loop_count
 
+    __slots__ = ('_title', '_parts')
+
     def __init__(self, sample_generator: pypsg.SampleGenerator, data_reader: DataReader):
         header = self._Header(data_reader)
         self._title = header.title
@@ -441,6 +497,8 @@ class SequenceSampleBlockGenerator:
     DEFAULT_INTERVAL_RATIO_HZ = 59.94
 
     class _ElapseTime:
+        __slots__ = ('_sampling_frequency_hz', '_seconds', '_remain_samples')
+
         def __init__(self, sampling_frequency_hz: int):
             self._sampling_frequency_hz = sampling_frequency_hz
             self._seconds = 0
@@ -457,6 +515,11 @@ class SequenceSampleBlockGenerator:
         def time(self) -> float:
             return self._seconds + self._remain_samples / self._sampling_frequency_hz
 
+    __slots__ = (
+        '_sample_generator', '_sequencer', '_interval_ratio_100x_hz',
+        '_sample_count_error', '_sample_remain', '_elapseTime',
+    )
+
     def __init__(
         self,
         sequencer: Sequencer,
@@ -481,21 +544,50 @@ class SequenceSampleBlockGenerator:
         return self._elapseTime.time
 
     def next(self, block_size: int) -> list[float] | None:
+        buffers = self._next(block_size, self._next_mixed_samples)
+        return None if buffers is None else buffers[0]
+
+    def skip(self, sample_count: int):
+        # Advances the sequencer by sample_count samples without synthesizing them (for seeking).
+        # The tone and noise generator phases are not advanced.
+        if sample_count < 0:
+            raise ValueError("sample_count < 0")
+        remain = sample_count
+        count = min(self._sample_remain, remain)
+        self._sample_remain -= count
+        remain -= count
+        while remain != 0 and self._sequencer.is_playing:
+            self._sequencer.tick()
+            (tick_sample_count, self._sample_count_error) = divmod(
+                self._sample_generator.sampling_frequency_hz * 100 + self._sample_count_error,
+                self._interval_ratio_100x_hz,
+            )
+            count = min(remain, tick_sample_count)
+            remain -= count
+            self._sample_remain = tick_sample_count - count
+        self._elapseTime.update(sample_count - remain)
+
+    def next_channels(self, block_size: int) -> tuple[list[float], list[list[float]]] | None:
+        # Returns the mixed block and one block per channel (stems) from a single pass.
+        channels = self._next(block_size, self._sample_generator.next_channel_samples)
+        if channels is None:
+            return None
+        (channel0, channel1, channel2) = channels
+        return (list(map(add, map(add, channel0, channel1), channel2)), channels)
+
+    def _next_mixed_samples(self, count: int) -> list[list[float]]:
+        return [self._sample_generator.next_samples(count)]
+
+    def _next(self, block_size: int, next_samples: Callable[[int], list[list[float]]]) -> list[list[float]] | None:
         if block_size < 0:
             raise ValueError("block_size < 0")
         if not self._sequencer.is_playing:
             return None
 
-        buffer = [0.0] * block_size
-        block_remain = block_size
-        sample_generator = self._sample_generator
-        index = 0
-        if self._sample_remain != 0:
-            count = min(self._sample_remain, block_remain)
-            buffer[:count] = [sample_generator.next_sample() for _ in range(count)]
-            self._sample_remain -= count
-            index = count
-            block_remain -= count
+        count = min(self._sample_remain, block_size)
+        buffers = next_samples(count)
+        self._sample_remain -= count
+        block_remain = block_size - count
 
         while block_remain != 0:
             self._sequencer.tick()
@@ -504,12 +596,419 @@ class SequenceSampleBlockGenerator:
                 self._interval_ratio_100x_hz,
             )
             count = min(block_remain, sample_count)
-            buffer[index: index + count] = [
-                sample_generator.next_sample() for _ in range(count)
-            ]
-            index += count
+            for (buffer, samples) in zip(buffers, next_samples(count)):
+                buffer += samples
             block_remain -= count
             self._sample_remain = sample_count - count
 
         self._elapseTime.update(block_size)
-        return buffer
+        return buffers
+
+
+class MultiRateSequenceSampleBlockGenerator:
+    __slots__ = (
+        '_sample_generator', '_sequencer', '_interval_ratio_100x_hz', '_clock_count_error', '_elapseTime',
+    )
+
+    def __init__(
+        self,
+        sequencer: Sequencer,
+        sample_generator: pypsg.MultiRateSampleGenerator,
+        interval_ratio_hz: float = None,
+    ):
+        interval_ratio_hz = (
+            SequenceSampleBlockGenerator.DEFAULT_INTERVAL_RATIO_HZ
+            if interval_ratio_hz is None
+            else interval_ratio_hz
+        )
+        self._sample_generator = sample_generator
+        self._sequencer = sequencer
+        self._interval_ratio_100x_hz = int(interval_ratio_hz * 100)
+        self._clock_count_error = 0
+        self._elapseTime = SequenceSampleBlockGenerator._ElapseTime(sample_generator.sampling_frequencies_hz[0])
+
+    @property
+    def elapse_time(self) -> float:
+        return self._elapseTime.time
+
+    def next(self, tick_count: int) -> list[list[float]] | None:
+        # Runs the sequencer up to tick_count times (until it stops) and returns one sample block per rate
+        # (in the order of sampling_frequencies_hz). The block sizes follow each sampling rate.
+        if tick_count < 0:
+            raise ValueError("tick_count < 0")
+        if not self._sequencer.is_playing:
+            return None
+
+        buffers = [[] for _ in self._sample_generator.sampling_frequencies_hz]
+        for _ in range(tick_count):
+            if not self._sequencer.is_playing:
+                break
+            self._sequencer.tick()
+            (clock_count, self._clock_count_error) = divmod(
+                self._sample_generator.master_frequency_hz * 100 + self._clock_count_error,
+                self._interval_ratio_100x_hz,
+            )
+            for (buffer, samples) in zip(buffers, self._sample_generator.next_samples(clock_count)):
+                buffer += samples
+
+        self._elapseTime.update(len(buffers[0]))
+        return buffers
+
+
+class IncrementalSequenceRenderer:
+    # Keeps the register trace, synthesis checkpoints and samples of the last render.
+    # render() runs only the sequencer (cheap) on the new data, finds the first tick whose register state
+    # differs from the last render and synthesizes from the checkpoint before that tick, keeping the
+    # samples before it. The samples are the same as rendering the whole song again.
+    DEFAULT_CHECKPOINT_INTERVAL_TICKS = 256
+
+    class _RegisterRecorder:
+        # Stands in for pypsg.SampleGenerator while sequencing.
+        class _Channel:
+            __slots__ = ('_is_tone_on', '_is_noise_on', '_volume', '_tune')
+
+            def __init__(self):
+                self._is_tone_on = True
+                self._is_noise_on = False
+                self._volume = 0
+                self._tune = None
+
+            @property
+            def is_tone_on(self):
+                return self._is_tone_on
+
+            def set_tone_on(self, is_on: bool):
+                self._is_tone_on = is_on
+
+            def set_noise_on(self, is_on: bool):
+                self._is_noise_on = is_on
+
+            def set_volume(self, value: int):
+                self._volume = value
+
+            def set_tune(self, tune: int):
+                self._tune = tune
+
+            def snapshot(self) -> tuple[bool, bool, int, int | None]:
+                return (self._is_tone_on, self._is_noise_on, self._volume, self._tune)
+
+        __slots__ = ('_channels', '_noise_frequency')
+
+        def __init__(self):
+            self._channels = [self._Channel() for ch in range(3)]
+            self._noise_frequency = None
+
+        def __getitem__(self, channel_number: int) -> _Channel:
+            return self._channels[channel_number]
+
+        def set_noise_frequency(self, frequency: int):
+            self._noise_frequency = frequency
+
+        def snapshot(self) -> tuple:
+            return (self._noise_frequency, *(channel.snapshot() for channel in self._channels))
+
+        @staticmethod
+        def apply(snapshot: tuple, sample_generator: pypsg.SampleGenerator):
+            (noise_frequency, *channels) = snapshot
+            if noise_frequency is not None:
+                sample_generator.set_noise_frequency(noise_frequency)
+            for (channel_number, (is_tone_on, is_noise_on, volume, tune)) in enumerate(channels):
+                channel = sample_generator[channel_number]
+                channel.set_tone_on(is_tone_on)
+                channel.set_noise_on(is_noise_on)
+                channel.set_volume(volume)
+                if tune is not None:
+                    channel.set_tune(tune)
+
+    class _Checkpoint:
+        __slots__ = ('sample_generator', 'sample_count_error', 'sample_offset')
+
+        def __init__(self, sample_generator: pypsg.SampleGenerator, sample_count_error: int, sample_offset: int):
+            self.sample_generator = copy.deepcopy(sample_generator)
+            self.sample_count_error = sample_count_error
+            self.sample_offset = sample_offset
+
+    __slots__ = (
+        '_master_frequency_hz', '_sampling_frequency_hz', '_band_limited', '_interval_ratio_100x_hz',
+        '_loop_count', '_max_ticks', '_checkpoint_interval_ticks',
+        '_trace', '_checkpoints', '_samples', '_rendered_from_tick',
+    )
+
+    def __init__(
+        self,
+        master_frequency_hz: int = None,
+        sampling_frequency_hz: int = None,
+        interval_ratio_hz: float = None,
+        loop_count: int = 1,
+        max_ticks: int = None,
+        checkpoint_interval_ticks: int = None,
+        band_limited: bool = False,
+    ):
+        # Renders until the song ends, the sequencer reaches loop_count (0: no limit) or max_ticks.
+        if loop_count == 0 and max_ticks is None:
+            raise ValueError("loop_count == 0 requires max_ticks")
+        interval_ratio_hz = (
+            SequenceSampleBlockGenerator.DEFAULT_INTERVAL_RATIO_HZ
+            if interval_ratio_hz is None
+            else interval_ratio_hz
+        )
+        self._master_frequency_hz = master_frequency_hz
+        self._sampling_frequency_hz = (
+            pypsg.SampleGenerator.DEFAULT_SAMPLING_FREQUENCY_HZ if sampling_frequency_hz is None else sampling_frequency_hz
+        )
+        self._band_limited = band_limited
+        self._interval_ratio_100x_hz = int(interval_ratio_hz * 100)
+        self._loop_count = loop_count
+        self._max_ticks = max_ticks
+        self._checkpoint_interval_ticks = (
+            self.DEFAULT_CHECKPOINT_INTERVAL_TICKS if checkpoint_interval_ticks is None else checkpoint_interval_ticks
+        )
+        self._trace = []
+        self._checkpoints = []
+        self._samples = []
+        self._rendered_from_tick = 0
+
+    @property
+    def sampling_frequency_hz(self) -> int:
+        return self._sampling_frequency_hz
+
+    @property
+    def rendered_from_tick(self) -> int:
+        # The first tick synthesized by the last render().
+        return self._rendered_from_tick
+
+    def _sequence(self, data_reader: Sequencer.DataReader) -> list[tuple]:
+        recorder = self._RegisterRecorder()
+        sequencer = Sequencer(recorder, data_reader)
+        trace = []
+        while sequencer.is_playing and (self._max_ticks is None or len(trace) < self._max_ticks):
+            sequencer.tick()
+            if self._loop_count != 0 and sequencer.loop_count >= self._loop_count:
+                break
+            trace.append(recorder.snapshot())
+        return trace
+
+    def render(self, data_reader: Sequencer.DataReader) -> list[float]:
+        trace = self._sequence(data_reader)
+        old_trace = self._trace
+        first_tick = 0
+        limit = min(len(trace), len(old_trace))
+        while first_tick < limit and trace[first_tick] == old_trace[first_tick]:
+            first_tick += 1
+        if first_tick == len(trace) == len(old_trace):
+            self._rendered_from_tick = first_tick
+            return self._samples[:]
+
+        interval = self._checkpoint_interval_ticks
+        if self._checkpoints:
+            checkpoint_index = min(first_tick // interval, len(self._checkpoints) - 1)
+            checkpoint = self._checkpoints[checkpoint_index]
+            del self._checkpoints[checkpoint_index + 1:]
+        else:
+            checkpoint_index = 0
+            checkpoint = self._Checkpoint(
+                pypsg.SampleGenerator(self._master_frequency_hz, self._sampling_frequency_hz, self._band_limited),
+                0,
+                0,
+            )
+            self._checkpoints.append(checkpoint)
+        sample_generator = copy.deepcopy(checkpoint.sample_generator)
+        sample_count_error = checkpoint.sample_count_error
+        samples = self._samples
+        del samples[checkpoint.sample_offset:]
+
+        start_tick = checkpoint_index * interval
+        for tick in range(start_tick, len(trace)):
+            if tick % interval == 0 and tick != start_tick:
+                self._checkpoints.append(self._Checkpoint(sample_generator, sample_count_error, len(samples)))
+            self._RegisterRecorder.apply(trace[tick], sample_generator)
+            (sample_count, sample_count_error) = divmod(
+                self._sampling_frequency_hz * 100 + sample_count_error,
+                self._interval_ratio_100x_hz,
+            )
+            samples.extend(sample_generator.next_samples(sample_count))
+
+        self._trace = trace
+        self._rendered_from_tick = start_tick
+        return samples[:]
+
+
+class SequenceAnalyzer:
+    # Walks the bytecode of each part like Part.tick() does, without synthesis.
+    # It checks every read against the data length, the opcodes and operands, the repeat structure and that
+    # the infinite loop advances time and the commands between two notes stay within MAX_COMMANDS_PER_TICK
+    # (counting the passes of repeats without notes, which are not walked one by one), and computes the exact
+    # tick lengths of the intro and the loop.
+    # Raises Sequencer.FormatError if the data would crash or hang the sequencer.
+    DEFAULT_MAX_TICKS = 60 * 60 * 60
+    DEFAULT_MAX_NESTING = 16
+    MAX_COMMANDS_PER_TICK = 1 << 16
+
+    class PartInfo:
+        __slots__ = ('channel_number', 'intro_ticks', 'loop_ticks', 'end_ticks')
+
+        def __init__(self, channel_number: int, intro_ticks: int | None, loop_ticks: int | None, end_ticks: int | None):
+            self.channel_number = channel_number
+            # Ticks played before the first infinite loop jump and ticks of one pass of the loop
+            # (None if the part ends).
+            self.intro_ticks = intro_ticks
+            self.loop_ticks = loop_ticks
+            # Ticks played before 0xFF (None if the part loops).
+            self.end_ticks = end_ticks
+
+    class _Walker:
+        def __init__(self, data_reader: Sequencer.DataReader, channel_number: int, max_ticks: int, max_nesting: int):
+            self._data_reader = data_reader
+            self._channel_number = channel_number
+            self._max_ticks = max_ticks
+            self._max_nesting = max_nesting
+
+        def _error(self, message: str, offset: int) -> Sequencer.FormatError:
+            return Sequencer.FormatError("part %d: %s at 0x%04x" % (self._channel_number, message, offset))
+
+        def _byte(self, offset: int) -> int:
+            if not 0 <= offset < self._data_reader.length:
+                raise self._error("read beyond the end of data", offset)
+            return self._data_reader.get_byte(offset)
+
+        def walk(self, offset: int) -> SequenceAnalyzer.PartInfo:
+            ticks = 0
+            commands = 0
+            # Repeat items: [count, start offset, end offset, ticks, volume and commands at the start of the pass]
+            stack = []
+            loop_points = {}
+            intro_ticks = None
+            volume = 0
+            while True:
+                command_offset = offset
+                data = self._byte(offset)
+                offset += 1
+                commands += 1
+                if data < 0x80:
+                    ticks += data + 1
+                    commands = 0
+                elif data < 0xE0:
+                    length = self._byte(offset)
+                    offset += 1
+                    ticks += length if length != 0 else 256
+                    if self._byte(offset) == 0xE8:
+                        offset += 1
+                    commands = 0
+                elif data == 0xE0 or data == 0xEB or data == 0xEC:
+                    self._byte(offset)
+                    offset += 1
+                elif data == 0xE1:
+                    volume = self._byte(offset)
+                    offset += 1
+                elif data == 0xE2:
+                    stack.append([self._byte(offset), offset + 1, None, ticks, volume, commands])
+                    offset += 1
+                    if len(stack) > self._max_nesting:
+                        raise self._error("repeat nesting too deep", command_offset)
+                elif data == 0xE3:
+                    if not stack:
+                        raise self._error("repeat break outside of a repeat", command_offset)
+                    item = stack[-1]
+                    if item[0] == 1:
+                        if item[2] is None:
+                            raise self._error("repeat break before the end of the repeat is known", command_offset)
+                        stack.pop()
+                        offset = item[2]
+                elif data == 0xE4:
+                    if not stack:
+                        raise self._error("unbalanced repeat end", command_offset)
+                    item = stack[-1]
+                    if item[0] == 0:
+                        if intro_ticks is None:
+                            intro_ticks = ticks
+                        key = (command_offset, tuple(tuple(item[:3]) for item in stack))
+                        if key in loop_points:
+                            if ticks == loop_points[key]:
+                                # Part.tick() would never return.
+                                raise self._error("no note is reached", command_offset)
+                            return SequenceAnalyzer.PartInfo(
+                                self._channel_number, intro_ticks, ticks - loop_points[key], None
+                            )
+                        loop_points[key] = ticks
+                        item[2:] = [offset, ticks, volume, commands]
+                        offset = item[1]
+                    else:
+                        item[0] -= 1
+                        if item[0] != 0:
+                            # A pass without ticks that leaves the volume unchanged repeats identically,
+                            # so only the commands of the remaining passes are counted before the last one.
+                            if ticks == item[3] and volume == item[4]:
+                                commands += (item[0] - 1) * (commands - item[5])
+                                item[0] = 1
+                            item[2:] = [offset, ticks, volume, commands]
+                            offset = item[1]
+                        else:
+                            stack.pop()
+                elif data == 0xE5:
+                    if self._byte(offset) > 31:
+                        raise self._error("noise frequency out of range", command_offset)
+                    offset += 1
+                elif data == 0xE6:
+                    volume += 0 if volume == 15 else 1
+                elif data == 0xE7:
+                    volume -= 0 if volume == 0 else 1
+                elif data == 0xE9:
+                    self._byte(offset + 1)
+                    offset += 2
+                elif data == 0xEA:
+                    self._byte(offset + 4)
+                    offset += 5
+                elif data == 0xFF:
+                    return SequenceAnalyzer.PartInfo(self._channel_number, None, None, ticks)
+                else:
+                    raise self._error("unknown opcode 0x%02x" % data, command_offset)
+                # The channel volume (envelope * volume) >> 8 must stay below 16.
+                if volume > 16:
+                    raise self._error("volume out of range", command_offset)
+                if ticks > self._max_ticks:
+                    raise self._error("longer than %d ticks" % self._max_ticks, command_offset)
+                if commands > SequenceAnalyzer.MAX_COMMANDS_PER_TICK:
+                    raise self._error("too many commands without a note", command_offset)
+
+    def __init__(self, data_reader: Sequencer.DataReader, max_ticks: int = None, max_nesting: int = None):
+        max_ticks = self.DEFAULT_MAX_TICKS if max_ticks is None else max_ticks
+        max_nesting = self.DEFAULT_MAX_NESTING if max_nesting is None else max_nesting
+        try:
+            header = Sequencer._Header(data_reader)
+        except IndexError:
+            raise Sequencer.FormatError("header: read beyond the end of data")
+        self._check_patch_table(data_reader, header.envelope_table_offset)
+        if all(offset is None for offset in header.channel_offsets):
+            raise Sequencer.FormatError("header: no parts")
+        self._parts = [
+            self._Walker(data_reader, channel_number, max_ticks, max_nesting).walk(offset)
+            for (channel_number, offset) in enumerate(header.channel_offsets)
+            if offset is not None
+        ]
+
+    @staticmethod
+    def _check_patch_table(data_reader: Sequencer.DataReader, offset: int):
+        while True:
+            if offset >= data_reader.length:
+                raise Sequencer.FormatError("patch table: read beyond the end of data")
+            if data_reader.get_byte(offset) == 0xFF:
+                return
+            offset += 7
+
+    @property
+    def parts(self) -> list[SequenceAnalyzer.PartInfo]:
+        return self._parts
+
+    @property
+    def is_looping(self) -> bool:
+        return all(part.end_ticks is None for part in self._parts)
+
+    def ticks(self, loop_count: int = 1) -> int | None:
+        # Number of Sequencer.tick() calls until the sequencer stops playing or Sequencer.loop_count reaches
+        # loop_count (0: no limit). None if that never happens.
+        end_ticks = [part.end_ticks for part in self._parts if part.end_ticks is not None]
+        if end_ticks:
+            return min(end_ticks) + 1
+        if loop_count == 0:
+            return None
+        return max(part.intro_ticks + (loop_count - 1) * part.loop_ticks for part in self._parts) + 1
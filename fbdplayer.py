@@ -1,11 +1,14 @@
 from __future__ import annotations
+import argparse
 import struct
-import sys
 import queue
-import wave
+import random
 import threading
-import sounddevice as sd
+import time
 import asyncio
+from abc import ABCMeta, abstractmethod
+from types import SimpleNamespace
+from typing import Any, Callable
 import janus
 
 import fbd
@@ -34,6 +37,196 @@ class FileDataReader(fbd.Sequencer.DataReader):
         return len(self._data)
 
 
+class OutputBackend(metaclass=ABCMeta):
+    # Raised by the stream callback (same meaning as sounddevice.CallbackStop / CallbackAbort).
+    # A backend whose device expects its own exception types replaces these.
+    class CallbackStop(Exception):
+        pass
+
+    class CallbackAbort(Exception):
+        pass
+
+    @abstractmethod
+    def open_stream(
+        self,
+        samplerate: int,
+        blocksize: int,
+        callback: Callable[[Any, int, Any, Any], None],
+        finished_callback: Callable[[], None],
+        buffered_time: Callable[[], float],
+    ):
+        # Returns a started stream as a context manager. callback has the sounddevice signature
+        # (outdata, frames, time, status) and buffered_time returns the seconds of samples queued by the player.
+        pass
+
+    def underrun(self) -> bool:
+        # Called by the player when it has no block for a callback (rendering did not keep up).
+        # Returns True to keep the stream running with a silent block, False to abort it.
+        # A backend that keeps the stream running is responsible for reporting the underruns.
+        return False
+
+    def output_underflow(self) -> bool:
+        # Called by the player when the callback status reports output_underflow. Same return value as underrun().
+        return False
+
+
+class SoundDeviceBackend(OutputBackend):
+    def __init__(self):
+        import sounddevice as sd
+        self._sd = sd
+        self.CallbackStop = sd.CallbackStop
+        self.CallbackAbort = sd.CallbackAbort
+
+    def open_stream(self, samplerate, blocksize, callback, finished_callback, buffered_time):
+        return self._sd.RawOutputStream(
+            samplerate=samplerate,
+            blocksize=blocksize,
+            channels=1,
+            dtype="float32",
+            callback=callback,
+            finished_callback=finished_callback,
+        )
+
+
+class SimulatedBackend(OutputBackend):
+    # Headless output device. The callback is invoked from a thread once per block period of wall-clock time
+    # and receives a virtual stream clock (currentTime, outputBufferDacTime = currentTime + latency).
+    # A callback that has no block from the player is an underrun; it is counted and the stream goes on with
+    # silence, so a run measures every underrun. A callback that completes after its DAC time is counted as late
+    # and sets status.output_underflow on the next callback, like a real device. jitter (seconds) delays each
+    # callback randomly and load (0.0 - 1.0) runs a busy thread that takes that share of the interpreter from
+    # the player.
+    class Report:
+        def __init__(self):
+            self.callback_count = 0
+            self.underrun_count = 0
+            self.late_callback_count = 0
+            self.is_aborted = False
+            self.min_margin = None
+            self._total_margin = 0.0
+            self.max_callback_latency = 0.0
+            self._total_callback_latency = 0.0
+
+        def add(self, margin: float, callback_latency: float, is_late: bool):
+            self.callback_count += 1
+            self.late_callback_count += 1 if is_late else 0
+            self.min_margin = margin if self.min_margin is None else min(self.min_margin, margin)
+            self._total_margin += margin
+            self.max_callback_latency = max(self.max_callback_latency, callback_latency)
+            self._total_callback_latency += callback_latency
+
+        def __str__(self) -> str:
+            count = max(self.callback_count, 1)
+            return (
+                "callbacks: %d underruns: %d late callbacks: %d aborted: %s\n"
+                "render-ahead margin: min %.1fms avg %.1fms\n"
+                "callback latency: max %.3fms avg %.3fms"
+                % (
+                    self.callback_count,
+                    self.underrun_count,
+                    self.late_callback_count,
+                    self.is_aborted,
+                    (self.min_margin or 0.0) * 1000,
+                    self._total_margin / count * 1000,
+                    self.max_callback_latency * 1000,
+                    self._total_callback_latency / count * 1000,
+                )
+            )
+
+    class _Stream:
+        def __init__(self, backend, samplerate, blocksize, callback, finished_callback, buffered_time):
+            self._backend = backend
+            self._samplerate = samplerate
+            self._blocksize = blocksize
+            self._callback = callback
+            self._finished_callback = finished_callback
+            self._buffered_time = buffered_time
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._load_thread = threading.Thread(target=self._run_load, daemon=True)
+
+        def __enter__(self):
+            self._thread.start()
+            if self._backend.load > 0:
+                self._load_thread.start()
+            return self
+
+        def __exit__(self, *args):
+            self._stop.set()
+            self._thread.join()
+            if self._load_thread.is_alive():
+                self._load_thread.join()
+
+        def _run_load(self):
+            slice_time = 0.001
+            while not self._stop.is_set():
+                end = time.perf_counter() + slice_time * self._backend.load
+                while time.perf_counter() < end:
+                    pass
+                time.sleep(slice_time * (1.0 - self._backend.load))
+
+        def _run(self):
+            backend = self._backend
+            report = backend.report
+            period = self._blocksize / self._samplerate
+            outdata = bytearray(self._blocksize * 4)
+            is_late = False
+            start = time.perf_counter()
+            index = 0
+            try:
+                while not self._stop.is_set():
+                    stream_time = index * period
+                    if backend.duration is not None and stream_time >= backend.duration:
+                        break
+                    deadline = start + stream_time
+                    wait = deadline + random.uniform(0.0, backend.jitter) - time.perf_counter()
+                    if wait > 0:
+                        time.sleep(wait)
+                    margin = self._buffered_time()
+                    begin = time.perf_counter()
+                    try:
+                        self._callback(
+                            outdata,
+                            self._blocksize,
+                            SimpleNamespace(
+                                currentTime=stream_time,
+                                outputBufferDacTime=stream_time + backend.latency,
+                                inputBufferAdcTime=0.0,
+                            ),
+                            SimpleNamespace(output_underflow=is_late),
+                        )
+                    except self._backend.CallbackStop:
+                        break
+                    except self._backend.CallbackAbort:
+                        report.is_aborted = True
+                        break
+                    end = time.perf_counter()
+                    is_late = end > deadline + backend.latency
+                    report.add(margin, end - begin, is_late)
+                    index += 1
+            finally:
+                self._stop.set()
+                self._finished_callback()
+
+    def __init__(self, latency: float = 0.01, jitter: float = 0.0, load: float = 0.0, duration: float = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.load = load
+        self.duration = duration
+        self.report = self.Report()
+
+    def open_stream(self, samplerate, blocksize, callback, finished_callback, buffered_time):
+        return self._Stream(self, samplerate, blocksize, callback, finished_callback, buffered_time)
+
+    def underrun(self) -> bool:
+        self.report.underrun_count += 1
+        return True
+
+    def output_underflow(self) -> bool:
+        # Already counted as a late callback.
+        return True
+
+
 class Player:
 
     class LoopTime:
@@ -52,7 +245,7 @@ class Player:
                     self._buffered_time = elapse_time
 
         def update_output(self, outputTime: float) -> None:
-            if not self._output_start_time:
+            if self._output_start_time is None:
                 self._output_start_time = outputTime
             self._output_time = outputTime - self._output_start_time
             with self._lock:
@@ -64,8 +257,17 @@ class Player:
             with self._lock:
                 return (self._output_time, self._output_loop_count)
 
-    def __init__(self, data_reader: fbd.Sequencer.DataReader, event_loop: asyncio.AbstractEventLoop):
-        self._sample_queue = janus.Queue(BUFFER_COUNT)
+    def __init__(
+        self,
+        data_reader: fbd.Sequencer.DataReader,
+        event_loop: asyncio.AbstractEventLoop,
+        backend: OutputBackend = None,
+        block_size: int = None,
+        buffer_count: int = None,
+    ):
+        self._backend = SoundDeviceBackend() if backend is None else backend
+        self._block_size = BUFFER_BLOCK_SIZE if block_size is None else block_size
+        self._sample_queue = janus.Queue(BUFFER_COUNT if buffer_count is None else buffer_count)
         self._finished_callback = asyncio.Event()
         self._end_samples = threading.Event()
         self._event_loop = event_loop
@@ -78,28 +280,27 @@ class Player:
 
         print(self._sequencer.title)
         for _ in range(self._sample_queue.maxsize):
-            data = self._sample_block_generator.next(BUFFER_BLOCK_SIZE)
+            data = self._sample_block_generator.next(self._block_size)
             if not data:
                 self._end_samples.set()
                 break
             self._sample_queue.async_q.put_nowait(data)
 
     async def within_stream(self):
-        with sd.RawOutputStream(
+        with self._backend.open_stream(
             samplerate=SAMPLING_FREQUENCY_HZ,
-            blocksize=BUFFER_BLOCK_SIZE,
-            channels=1,
-            dtype="float32",
+            blocksize=self._block_size,
             callback=lambda outdata, _, time, status: self._callback(
                 outdata, time, status
             ),
-            finished_callback=lambda: (self._event_loop.call_soon_threadsafe(self._finished_callback.set), None)[1]
+            finished_callback=lambda: (self._event_loop.call_soon_threadsafe(self._finished_callback.set), None)[1],
+            buffered_time=lambda: self._sample_queue.sync_q.qsize() * self._block_size / SAMPLING_FREQUENCY_HZ,
         ):
             await self._finished_callback.wait()
 
     async def fill_samples(self):
         while True:
-            data = self._sample_block_generator.next(BUFFER_BLOCK_SIZE)
+            data = self._sample_block_generator.next(self._block_size)
             if not data:
                 self._end_samples.set()
                 break
@@ -111,17 +312,19 @@ class Player:
 
     def _callback(self, outdata, time, status):
         self._loop_time.update_output(time.outputBufferDacTime)
-        if status.output_underflow:
+        if status.output_underflow and not self._backend.output_underflow():
             print("Output underflow")
-            raise sd.CallbackAbort
+            raise self._backend.CallbackAbort
         try:
             data = self._sample_queue.sync_q.get_nowait()
         except queue.Empty as e:
-            if self._end_samples.is_set:
-                raise sd.CallbackStop
-            else:
+            if self._end_samples.is_set():
+                raise self._backend.CallbackStop
+            if not self._backend.underrun():
                 print("Buffer is empty")
-                raise sd.CallbackAbort from e
+                raise self._backend.CallbackAbort from e
+            outdata[:] = bytes(len(outdata))
+            return
         outdata[:] = struct.pack("f" * len(data), *data)
 
     @staticmethod
@@ -138,15 +341,35 @@ class Player:
             end="\r", flush=True
         )
 
-async def main() -> None:
-    data_reader = FileDataReader(sys.argv[1])
-    # test_write(data_reader)
-    player = Player(data_reader, asyncio.get_running_loop())
-    await asyncio.gather(player.within_stream(), player.fill_samples())
-
-try:
-    asyncio.run(main())
-except KeyboardInterrupt:
-    pass
-finally:
-    print('')
+async def main(args: argparse.Namespace) -> None:
+    data_reader = FileDataReader(args.fbd_filename)
+    backend = (
+        SimulatedBackend(args.latency, args.jitter, args.load, args.duration)
+        if args.simulate
+        else None
+    )
+    player = Player(data_reader, asyncio.get_running_loop(), backend, args.block_size, args.buffer_count)
+    fill_samples = asyncio.ensure_future(player.fill_samples())
+    await player.within_stream()
+    fill_samples.cancel()
+    if args.simulate:
+        print('')
+        print(backend.report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plays a fbd file.")
+    parser.add_argument("fbd_filename")
+    parser.add_argument("--block-size", type=int, default=BUFFER_BLOCK_SIZE)
+    parser.add_argument("--buffer-count", type=int, default=BUFFER_COUNT)
+    parser.add_argument("--simulate", action="store_true", help="use a headless simulated output device")
+    parser.add_argument("--duration", type=float, default=None, help="simulated playback length in seconds")
+    parser.add_argument("--latency", type=float, default=0.01, help="simulated output latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="simulated callback jitter in seconds")
+    parser.add_argument("--load", type=float, default=0.0, help="simulated CPU load (0.0 - 1.0)")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print('')
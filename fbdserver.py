@@ -0,0 +1,358 @@
+from __future__ import annotations
+import argparse
+import asyncio
+import math
+import os
+import traceback
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fbd
+import pypsg
+
+PSG_MASTER_CLOCK_HZ = 1789772
+SAMPLING_FREQUENCY_HZ = 48000
+INTERVAL_RATIO_HZ = 59.94
+BLOCK_SIZE = 4096
+DATA_DIRECTORY = "data"
+DEFAULT_PORT = 8910
+DEFAULT_WORKERS = 4
+DEFAULT_CACHE_SIZE = 32
+MIN_SAMPLING_FREQUENCY_HZ = 8000
+MAX_SAMPLING_FREQUENCY_HZ = 192000
+MAX_START_SECONDS = 60 * 60
+BROADCAST_REQUEST = "LISTEN"
+BROADCAST_RING_SIZE = 64
+BROADCAST_LEAD_BLOCKS = 4
+BROADCAST_SEND_TIMEOUT = 5.0
+REQUEST_TIMEOUT = 10.0
+
+
+class BytesDataReader(fbd.Sequencer.DataReader):
+    def __init__(self, data: bytes):
+        self._data = data
+
+    def get_byte(self, offset: int) -> int:
+        return self._data[offset]
+
+    def get_short(self, offset: int) -> int:
+        return self._data[offset] | self._data[offset + 1] << 8
+
+    @property
+    def length(self) -> int:
+        return len(self._data)
+
+
+class RequestError(Exception):
+    pass
+
+
+class SongCache:
+    # LRU of song data shared by all connections. get() reads the file, so it is called from the executor.
+    def __init__(self, directory: str, max_size: int):
+        self._directory = directory
+        self._max_size = max_size
+        self._songs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, name: str) -> str:
+        if os.path.basename(name) != name or name.startswith("."):
+            raise RequestError("invalid song name")
+        if not name.endswith(".fbd"):
+            name += ".fbd"
+        return os.path.join(self._directory, name)
+
+    def get(self, name: str) -> bytes:
+        path = self._path(name)
+        with self._lock:
+            data = self._songs.get(path)
+            if data is not None:
+                self._songs.move_to_end(path)
+                return data
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            raise RequestError("song not found") from e
+        with self._lock:
+            self._songs[path] = data
+            if len(self._songs) > self._max_size:
+                self._songs.popitem(last=False)
+        return data
+
+
+class RenderJob:
+    # Renders one request block by block. next_block() runs on a worker thread.
+    def __init__(self, data: bytes, sampling_frequency_hz: int, start: float, loop_count: int):
+        data_reader = BytesDataReader(data)
+        try:
+            analyzer = fbd.SequenceAnalyzer(data_reader)
+        except fbd.Sequencer.FormatError as e:
+            raise RequestError("invalid song data (%s)" % e) from e
+        # Seeking runs the sequencer, so the start must be within the rendered length (and MAX_START_SECONDS).
+        ticks = analyzer.ticks(loop_count)
+        if start > (MAX_START_SECONDS if ticks is None else min(ticks / INTERVAL_RATIO_HZ, MAX_START_SECONDS)):
+            raise RequestError("start out of range")
+        sample_generator = pypsg.SampleGenerator(PSG_MASTER_CLOCK_HZ, sampling_frequency_hz)
+        self._sequencer = fbd.Sequencer(sample_generator, data_reader)
+        self._generator = fbd.SequenceSampleBlockGenerator(
+            self._sequencer, sample_generator, INTERVAL_RATIO_HZ
+        )
+        self._sampling_frequency_hz = sampling_frequency_hz
+        self._loop_count = loop_count
+        self._generator.skip(int(start * sampling_frequency_hz))
+
+    @property
+    def sampling_frequency_hz(self) -> int:
+        return self._sampling_frequency_hz
+
+    def next_block(self) -> bytes | None:
+        block = self._generator.next(BLOCK_SIZE)
+        if not block or (self._loop_count != 0 and self._sequencer.loop_count >= self._loop_count):
+            return None
+        return struct.pack("<%dh" % len(block), *[int(value * 32767) for value in block])
+
+
+class BlockRing:
+    # Fixed size ring of blocks addressed by an ever increasing position.
+    def __init__(self, size: int):
+        self._blocks = [None] * size
+        self._next_position = 0
+
+    @property
+    def next_position(self) -> int:
+        return self._next_position
+
+    @property
+    def oldest_position(self) -> int:
+        return max(0, self._next_position - len(self._blocks))
+
+    def append(self, data: bytes):
+        self._blocks[self._next_position % len(self._blocks)] = data
+        self._next_position += 1
+
+    def __getitem__(self, position: int) -> bytes:
+        if not self.oldest_position <= position < self._next_position:
+            raise IndexError("position is not in the ring")
+        return self._blocks[position % len(self._blocks)]
+
+
+class Broadcast:
+    # Renders a playlist once, in real time, into a BlockRing. Each listener reads the ring at its own
+    # position. A listener that falls out of the ring skips ahead to the live position and a listener
+    # that does not accept a block within BROADCAST_SEND_TIMEOUT is dropped, so the producer never waits
+    # for listeners and the rendering cost does not depend on the number of listeners.
+    def __init__(
+        self,
+        song_cache: SongCache,
+        executor: ThreadPoolExecutor,
+        playlist: list[str],
+        sampling_frequency_hz: int = None,
+    ):
+        self._song_cache = song_cache
+        self._executor = executor
+        self._playlist = playlist
+        self._sampling_frequency_hz = (
+            SAMPLING_FREQUENCY_HZ if sampling_frequency_hz is None else sampling_frequency_hz
+        )
+        self._ring = BlockRing(BROADCAST_RING_SIZE)
+        self._updated = asyncio.Condition()
+        self._is_finished = False
+
+    @property
+    def sampling_frequency_hz(self) -> int:
+        return self._sampling_frequency_hz
+
+    @property
+    def is_finished(self) -> bool:
+        return self._is_finished
+
+    async def produce(self):
+        try:
+            await self._produce()
+        finally:
+            # Wake up the listeners so that they close their connections.
+            self._is_finished = True
+            async with self._updated:
+                self._updated.notify_all()
+
+    async def _produce(self):
+        loop = asyncio.get_running_loop()
+        block_time = BLOCK_SIZE / self._sampling_frequency_hz
+        start_time = loop.time()
+        block_count = 0
+        while True:
+            playlist_block_count = block_count
+            for name in self._playlist:
+                try:
+                    data = await loop.run_in_executor(self._executor, self._song_cache.get, name)
+                    job = await loop.run_in_executor(
+                        self._executor, RenderJob, data, self._sampling_frequency_hz, 0.0, 1
+                    )
+                except RequestError as e:
+                    print("%s: %s" % (name, e))
+                    continue
+                while True:
+                    data = await loop.run_in_executor(self._executor, job.next_block)
+                    if data is None:
+                        break
+                    async with self._updated:
+                        self._ring.append(data)
+                        self._updated.notify_all()
+                    block_count += 1
+                    delay = start_time + (block_count - BROADCAST_LEAD_BLOCKS) * block_time - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+            if block_count == playlist_block_count:
+                print("broadcast: no playable song")
+                return
+
+    async def listen(self, writer: asyncio.StreamWriter):
+        position = max(self._ring.oldest_position, self._ring.next_position - BROADCAST_LEAD_BLOCKS)
+        while True:
+            async with self._updated:
+                await self._updated.wait_for(
+                    lambda: self._ring.next_position > position or self._is_finished
+                )
+            if self._ring.next_position <= position:
+                return
+            if position < self._ring.oldest_position:
+                position = self._ring.next_position - 1
+            writer.write(self._ring[position])
+            position += 1
+            try:
+                await asyncio.wait_for(writer.drain(), BROADCAST_SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                return
+
+
+class RenderServer:
+    # Protocol: the client sends one line
+    #   <song> [<sampling frequency hz> [<start seconds> [<loop count>]]]
+    # and receives "OK <sampling frequency hz>\n" followed by s16le mono PCM until the end of the song
+    # (or "ERROR <message>\n"). The line must arrive within REQUEST_TIMEOUT seconds.
+    # If the line is BROADCAST_REQUEST, the client joins the broadcast instead (see Broadcast).
+    # A block is rendered only after the previous one has been drained to the client, so every connection
+    # holds at most one block and slow clients never make rendering run ahead.
+    def __init__(self, song_cache: SongCache, workers: int, playlist: list[str] = None):
+        self._song_cache = song_cache
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._broadcast = Broadcast(song_cache, self._executor, playlist) if playlist else None
+
+    @staticmethod
+    def _parse_request(line: bytes) -> tuple[str, int, float, int]:
+        try:
+            fields = line.decode("utf8").split()
+        except UnicodeDecodeError as e:
+            raise RequestError("invalid request") from e
+        if not 1 <= len(fields) <= 4:
+            raise RequestError("invalid request")
+        try:
+            sampling_frequency_hz = int(fields[1]) if len(fields) > 1 else SAMPLING_FREQUENCY_HZ
+            start = float(fields[2]) if len(fields) > 2 else 0.0
+            loop_count = int(fields[3]) if len(fields) > 3 else 1
+        except ValueError as e:
+            raise RequestError("invalid request") from e
+        if not MIN_SAMPLING_FREQUENCY_HZ <= sampling_frequency_hz <= MAX_SAMPLING_FREQUENCY_HZ:
+            raise RequestError("sampling frequency out of range")
+        if not math.isfinite(start) or start < 0 or loop_count < 0:
+            raise RequestError("invalid request")
+        return (fields[0], sampling_frequency_hz, start, loop_count)
+
+    async def _open_job(self, line: bytes) -> RenderJob:
+        (name, sampling_frequency_hz, start, loop_count) = self._parse_request(line)
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(self._executor, self._song_cache.get, name)
+        return await loop.run_in_executor(
+            self._executor, RenderJob, data, sampling_frequency_hz, start, loop_count
+        )
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                writer.write(b"ERROR request timeout\n")
+                await writer.drain()
+                return
+            except (ValueError, asyncio.LimitOverrunError):
+                # The line is longer than the stream limit.
+                writer.write(b"ERROR invalid request\n")
+                await writer.drain()
+                return
+            if line.strip() == BROADCAST_REQUEST.encode("utf8"):
+                if self._broadcast is None or self._broadcast.is_finished:
+                    writer.write(b"ERROR broadcast is not available\n")
+                    await writer.drain()
+                else:
+                    writer.write(b"OK %d\n" % self._broadcast.sampling_frequency_hz)
+                    await self._broadcast.listen(writer)
+                return
+            try:
+                job = await self._open_job(line)
+            except RequestError as e:
+                writer.write(b"ERROR %s\n" % str(e).encode("utf8"))
+                await writer.drain()
+                return
+            except Exception:
+                traceback.print_exc()
+                writer.write(b"ERROR internal error\n")
+                await writer.drain()
+                return
+            writer.write(b"OK %d\n" % job.sampling_frequency_hz)
+            while True:
+                data = await loop.run_in_executor(self._executor, job.next_block)
+                if data is None:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            # The PCM stream has started, so the connection is just closed.
+            traceback.print_exc()
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = None, port: int = None, path: str = None):
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            if self._broadcast is not None:
+                await asyncio.gather(server.serve_forever(), self._broadcast.produce())
+            else:
+                await server.serve_forever()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streams rendered fbd files to local clients.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix", default=None, help="listen on a unix domain socket instead of TCP")
+    parser.add_argument("--data", default=DATA_DIRECTORY, help="directory of fbd files")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, help="number of songs kept in memory")
+    parser.add_argument(
+        "--broadcast", nargs="+", default=None, metavar="SONG", help="songs played in turn to %s clients" % BROADCAST_REQUEST
+    )
+    args = parser.parse_args()
+
+    server = RenderServer(SongCache(args.data, args.cache_size), args.workers, args.broadcast)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
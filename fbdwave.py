@@ -1,7 +1,12 @@
 from __future__ import annotations
+import argparse
+import os
+import socket
 import struct
 import sys
+import urllib.parse
 import wave
+from typing import BinaryIO, TextIO
 
 import fbd
 import pypsg
@@ -28,28 +33,157 @@ class FileDataReader(fbd.Sequencer.DataReader):
         return len(self._data)
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print('usage: fbdwave.py <fbd filename> <wav filename>')
-        sys.exit(0)
-
-    data_reader = FileDataReader(sys.argv[1])
-    with wave.open(sys.argv[2], "w") as wf:
-        wf.setnchannels(1)
-        wf.setsampwidth(2)
-        wf.setframerate(SAMPLING_FREQUENCY_HZ)
-        sample_generator = pypsg.SampleGenerator(PSG_MASTER_CLOCK_HZ, SAMPLING_FREQUENCY_HZ)
-        sequencer = fbd.Sequencer(sample_generator, data_reader)
-        generator = fbd.SequenceSampleBlockGenerator(
-            sequencer, sample_generator, INTERVAL_RATIO_HZ
+class StreamWriter:
+    # Writes 16bit mono PCM to a non-seekable stream (stdout, pipe or socket).
+    # Each block is written and flushed before the next one is rendered, so a blocking sink
+    # applies back-pressure and rendering never runs more than one block ahead of the consumer.
+    UNKNOWN_LENGTH = 0xFFFFFFFF
+
+    def __init__(self, stream: BinaryIO, sampling_frequency_hz: int, raw: bool = False):
+        self._stream = stream
+        self._sampling_frequency_hz = sampling_frequency_hz
+        self._raw = raw
+        self._is_header_written = False
+
+    def _write_header(self):
+        # WAV header with unknown length (accepted by ffmpeg, sox and most players).
+        channels = 1
+        sample_width = 2
+        self._stream.write(
+            struct.pack(
+                "<4sI4s4sIHHIIHH4sI",
+                b"RIFF",
+                self.UNKNOWN_LENGTH,
+                b"WAVE",
+                b"fmt ",
+                16,
+                1,
+                channels,
+                self._sampling_frequency_hz,
+                self._sampling_frequency_hz * channels * sample_width,
+                channels * sample_width,
+                sample_width * 8,
+                b"data",
+                self.UNKNOWN_LENGTH,
+            )
+        )
+
+    def writeframes(self, data: bytes):
+        if not self._is_header_written:
+            if not self._raw:
+                self._write_header()
+            self._is_header_written = True
+        self._stream.write(data)
+        self._stream.flush()
+
+
+def parse_target(output: str) -> tuple[str, int] | None:
+    # "-" is stdout (None), "tcp://<host>:<port>" is (host, port). An IPv6 host is written in brackets.
+    # Raises ValueError if the target is malformed.
+    if output == "-":
+        return None
+    url = urllib.parse.urlsplit(output)
+    try:
+        port = url.port
+    except ValueError as e:
+        raise ValueError("invalid port in %s" % output) from e
+    if url.scheme != "tcp" or not url.hostname or port is None or url.path or url.query or url.fragment:
+        raise ValueError('invalid target %s (expected "tcp://<host>:<port>")' % output)
+    return (url.hostname, port)
+
+
+def open_stream(target: tuple[str, int] | None) -> tuple[BinaryIO, socket.socket | None]:
+    # target is the result of parse_target(). None is stdout, (host, port) connects to a listening socket.
+    # Returns the stream and the socket (None for stdout), which the caller closes.
+    if target is None:
+        return (sys.stdout.buffer, None)
+    sock = socket.create_connection(target)
+    return (sock.makefile("wb"), sock)
+
+
+def render(
+    generator: fbd.SequenceSampleBlockGenerator,
+    sequencer: fbd.Sequencer,
+    writer: wave.Wave_write | StreamWriter,
+    loop_count: int = 1,
+    duration: float = None,
+    progress: TextIO = None,
+):
+    # Stops when the song ends, when the sequencer reaches loop_count (0: no limit),
+    # or after duration seconds (None: no limit).
+    remain_samples = None if duration is None else int(duration * SAMPLING_FREQUENCY_HZ)
+    while remain_samples is None or remain_samples > 0:
+        block_size = BLOCK_SIZE if remain_samples is None else min(BLOCK_SIZE, remain_samples)
+        block = generator.next(block_size)
+        if not block or (loop_count != 0 and sequencer.loop_count >= loop_count):
+            break
+        writer.writeframes(
+            struct.pack("h" * len(block), *[int(value * 32767) for value in block])
         )
-        print(sequencer.title)
-        while True:
-            block = generator.next(BLOCK_SIZE)
-            if not block or sequencer.loop_count != 0:
-                break
-            wf.writeframes(
-                struct.pack("h" * len(block), *[int(value * 32767) for value in block])
+        if remain_samples is not None:
+            remain_samples -= len(block)
+        if progress is not None:
+            print(".", end="", flush=True, file=progress)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates a .wav from a fbd file.")
+    parser.add_argument("fbd_filename")
+    parser.add_argument(
+        "wav_filename",
+        help='output filename, "-" for stdout or "tcp://<host>:<port>" (streamed with an unknown length header)',
+    )
+    parser.add_argument("--raw", action="store_true", help="write headerless PCM (s16le, mono) when streaming")
+    parser.add_argument(
+        "--loop-count", type=int, default=1, help="stop when the song has looped this many times (0: no limit)"
+    )
+    parser.add_argument("--duration", type=float, default=None, help="stop after this many seconds")
+    args = parser.parse_args()
+    is_stream = args.wav_filename == "-" or args.wav_filename.startswith("tcp://")
+    progress = sys.stderr if is_stream else sys.stdout
+    if is_stream:
+        try:
+            target = parse_target(args.wav_filename)
+        except ValueError as e:
+            parser.error(str(e))
+
+    data_reader = FileDataReader(args.fbd_filename)
+    try:
+        analyzer = fbd.SequenceAnalyzer(data_reader)
+    except fbd.Sequencer.FormatError as e:
+        print("%s: %s" % (args.fbd_filename, e), file=sys.stderr)
+        sys.exit(1)
+    if args.loop_count == 0 and args.duration is None and analyzer.is_looping:
+        parser.error("--loop-count 0 requires --duration for a looping song")
+    sample_generator = pypsg.SampleGenerator(PSG_MASTER_CLOCK_HZ, SAMPLING_FREQUENCY_HZ)
+    sequencer = fbd.Sequencer(sample_generator, data_reader)
+    generator = fbd.SequenceSampleBlockGenerator(
+        sequencer, sample_generator, INTERVAL_RATIO_HZ
+    )
+    print(sequencer.title, file=progress)
+    if is_stream:
+        (stream, sock) = open_stream(target)
+        try:
+            render(
+                generator, sequencer, StreamWriter(stream, SAMPLING_FREQUENCY_HZ, args.raw),
+                args.loop_count, args.duration, progress
             )
-            print(".", end="", flush=True)
-    print('')
+        except ConnectionError:
+            # The consumer went away. Python flushes stdout again at exit, so redirect it.
+            if sock is None:
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        finally:
+            if sock is not None:
+                try:
+                    stream.close()
+                    sock.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+                sock.close()
+    else:
+        with wave.open(args.wav_filename, "w") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(SAMPLING_FREQUENCY_HZ)
+            render(generator, sequencer, wf, args.loop_count, args.duration, progress)
+    print('', file=progress)
@@ -1,8 +1,15 @@
+from __future__ import annotations
+from array import array
+from operator import add
+
+
 class SampleGenerator:
     DEFAULT_SAMPLING_FREQUENCY_HZ = 48000
     DEFAULT_MASTER_FREQUENCY_HZ = 1789772
 
     class _MixingLookupTable:
+        __slots__ = ('_data',)
+
         def __init__(self):
             # The following table generation was based on fmgen_008.lzh (Copyright (C) cisc 1997, 1999)
             # URL: http://retropc.net/cisc/sound/
@@ -14,13 +21,24 @@ class SampleGenerator:
         def __getitem__(self, index: int) -> float:
             return self._data[index]
 
+    # Shared by all instances.
+    _mixing_lookup_table = _MixingLookupTable()
+
     class ToneChannel:
         class _ToneGenerator:
-            def __init__(self, master_frequency_hz: int, sampling_frequency_hz: int):
+            __slots__ = (
+                '_master_frequency_hz', '_sampling_frequency_8x_hz', '_error', '_tune_min',
+                '_source', '_next_source', '_output',
+            )
+
+            def __init__(self, master_frequency_hz: int, sampling_frequency_hz: int, limit_frequency_hz: int = None):
+                # Tunes are limited so that the output toggles at most once per sample at limit_frequency_hz
+                # (sampling_frequency_hz by default).
+                limit_frequency_hz = sampling_frequency_hz if limit_frequency_hz is None else limit_frequency_hz
                 self._master_frequency_hz = master_frequency_hz
                 self._sampling_frequency_8x_hz = sampling_frequency_hz * 8
                 self._error = self._master_frequency_hz
-                self._tune_min = self._master_frequency_hz // self._sampling_frequency_8x_hz + 1
+                self._tune_min = self._master_frequency_hz // (limit_frequency_hz * 8) + 1
                 self._source = self._tune_min * self._sampling_frequency_8x_hz
                 self._next_source = self._source
                 self._output = False
@@ -40,11 +58,49 @@ class SampleGenerator:
                     self._source = self._next_source
                 return self._output
 
-        def __init__(self, master_frequency_hz: int, sampling_frequency_hz: int):
+            def update_edge(self) -> float:
+                # Returns the distance (0.0 < d <= 1.0 sample) from the toggle to the current sample point,
+                # or 0.0 if the output did not toggle. At most one toggle can occur per sample (see _tune_min).
+                self._error -= self._master_frequency_hz
+                if self._error < 0:
+                    edge = -self._error / self._master_frequency_hz
+                    self._error += self._source
+                    self._output = not self._output
+                    self._source = self._next_source
+                    return edge
+                return 0.0
+
+            def steady_count(self) -> int:
+                # Number of upcoming samples without a toggle.
+                return self._error // self._master_frequency_hz
+
+            def advance(self, count: int):
+                # Same as calling update() count times.
+                self._error -= self._master_frequency_hz * count
+                if self._error < 0:
+                    self._error += self._source
+                    self._output = not self._output
+                    self._source = self._next_source
+                    if self._error < 0:
+                        toggle_count = (self._source - 1 - self._error) // self._source
+                        self._error += toggle_count * self._source
+                        if toggle_count & 1:
+                            self._output = not self._output
+
+            @property
+            def output(self) -> bool:
+                return self._output
+
+        __slots__ = ('_volume', '_is_tone_on', '_is_noise_on', '_tone_generator', '_blep_pending')
+
+        def __init__(self, master_frequency_hz: int, sampling_frequency_hz: int, limit_frequency_hz: int = None):
             self._volume = 0
             self._is_tone_on = True
             self._is_noise_on = False
-            self._tone_generator = self._ToneGenerator(master_frequency_hz, sampling_frequency_hz)
+            self._tone_generator = self._ToneGenerator(
+                master_frequency_hz, sampling_frequency_hz, limit_frequency_hz
+            )
+            self._blep_pending = 0.0
 
         @property
         def is_tone_on(self):
@@ -53,9 +109,17 @@ class SampleGenerator:
         def set_tone_on(self, is_on: bool):
             self._is_tone_on = is_on
 
+        @property
+        def is_noise_on(self):
+            return self._is_noise_on
+
         def set_noise_on(self, is_on: bool):
             self._is_noise_on = is_on
 
+        @property
+        def volume(self) -> int:
+            return self._volume
+
         def set_volume(self, value: int):
             if value < 0 or value > 15:
                 raise ValueError('volume >= 0 and volume < 16')
@@ -70,13 +134,150 @@ class SampleGenerator:
                 if (self._tone_generator.update() & self._is_tone_on) or (isNoise & self._is_noise_on) else 0
             )
 
+        def steady_mix_with_noise(self, isNoise: bool) -> int:
+            # Same as mix_with_noise() without advancing the tone generator.
+            return (
+                self._volume
+                if (self._tone_generator.output & self._is_tone_on) or (isNoise & self._is_noise_on) else 0
+            )
+
+        def next_samples(
+            self,
+            count: int,
+            level: float,
+            is_noise: bool,
+            noise_changes: list[tuple[int, float, bool]],
+            band_limited: bool,
+        ) -> list[float]:
+            # Same as count calls of mix_with_noise() (with level for the volume, see _MixingLookupTable) or of
+            # mix_with_noise_band_limited(), given the noise output at the first sample and its changes
+            # (see _NoiseGenerator.next_changes()). Between the edges of the tone and the noise changes that
+            # can be heard, the output is constant and filled in bulk.
+            buffer = []
+            if not band_limited:
+                changes = self.next_changes(count, level, is_noise, noise_changes)
+                for ((index, value), (next_index, _)) in zip(changes, changes[1:] + [(count, None)]):
+                    buffer += [value] * (next_index - index)
+                return buffer
+            tone_generator = self._tone_generator
+            is_tone_edge_heard = self._is_tone_on and self._volume != 0
+            changes = iter(noise_changes if self._is_noise_on and self._volume != 0 else ())
+            (change_index, noise_edge, next_is_noise) = next(changes, (count, 0.0, is_noise))
+            index = 0
+            while True:
+                next_index = change_index
+                if is_tone_edge_heard:
+                    next_index = min(next_index, index + tone_generator.steady_count())
+                span = min(next_index, count) - index
+                if span > 0:
+                    value = level if self.steady_mix_with_noise(is_noise) else 0.0
+                    # The first sample still carries the residual of the last edge.
+                    buffer.append(self._blep_pending)
+                    buffer += [value] * (span - 1)
+                    self._blep_pending = value
+                    tone_generator.advance(span)
+                    index += span
+                if index == count:
+                    return buffer
+                is_noise_before = is_noise
+                edge = 0.0
+                if index == change_index:
+                    (is_noise, edge) = (next_is_noise, noise_edge)
+                    (change_index, noise_edge, next_is_noise) = next(changes, (count, 0.0, is_noise))
+                buffer.append(self.mix_with_noise_band_limited(level, is_noise_before, is_noise, edge))
+                index += 1
+
+        def next_changes(
+            self, count: int, level: float, is_noise: bool, noise_changes: list[tuple[int, float, bool]]
+        ) -> list[tuple[int, float]]:
+            # Same as next_samples() without the band-limited mode, but returns only the changes of the output
+            # as (sample index, output), starting with the first sample.
+            tone_generator = self._tone_generator
+            is_tone_edge_heard = self._is_tone_on and self._volume != 0
+            changes = iter(noise_changes if self._is_noise_on and self._volume != 0 else ())
+            (change_index, _, next_is_noise) = next(changes, (count, 0.0, is_noise))
+            output_changes = []
+            output = None
+            index = 0
+            while True:
+                next_index = change_index
+                if is_tone_edge_heard:
+                    next_index = min(next_index, index + tone_generator.steady_count())
+                span = min(next_index, count) - index
+                if span > 0:
+                    value = level if self.steady_mix_with_noise(is_noise) else 0.0
+                    if value != output:
+                        output_changes.append((index, value))
+                        output = value
+                    tone_generator.advance(span)
+                    index += span
+                if index == count:
+                    return output_changes
+                if index == change_index:
+                    is_noise = next_is_noise
+                    (change_index, _, next_is_noise) = next(changes, (count, 0.0, is_noise))
+                value = level if self.mix_with_noise(is_noise) else 0.0
+                if value != output:
+                    output_changes.append((index, value))
+                    output = value
+                index += 1
+
+        def mix_with_noise_band_limited(
+            self, level: float, is_noise_before: bool, is_noise: bool, noise_edge: float
+        ) -> float:
+            # Band-limited step (polyBLEP) mixing. Each output step is placed at its sub-sample position
+            # and its residual is spread over the previous and the current sample, so the result is
+            # delayed by one sample.
+            is_tone_before = self._tone_generator.output
+            tone_edge = self._tone_generator.update_edge()
+            is_tone = self._tone_generator.output
+            previous = self._blep_pending
+            current = (
+                level if (is_tone & self._is_tone_on) or (is_noise & self._is_noise_on) else 0.0
+            )
+            if tone_edge or noise_edge:
+                # Larger distance means earlier edge.
+                if tone_edge >= noise_edge:
+                    edges = ((tone_edge, is_tone, is_noise_before), (noise_edge, is_tone, is_noise))
+                else:
+                    edges = ((noise_edge, is_tone_before, is_noise), (tone_edge, is_tone, is_noise))
+                output = (
+                    level if (is_tone_before & self._is_tone_on) or (is_noise_before & self._is_noise_on) else 0.0
+                )
+                for (edge, edge_tone, edge_noise) in edges:
+                    if edge == 0.0:
+                        continue
+                    next_output = (
+                        level if (edge_tone & self._is_tone_on) or (edge_noise & self._is_noise_on) else 0.0
+                    )
+                    step = next_output - output
+                    if step != 0.0:
+                        previous += step * edge * edge * 0.5
+                        current -= step * (1.0 - edge) * (1.0 - edge) * 0.5
+                    output = next_output
+            self._blep_pending = current
+            return previous
+
     class _NoiseGenerator:
-        def __init__(self, master_frequency_hz: int, sampling_frequency_hz: int):
+        __slots__ = (
+            '_master_frequency_hz', '_sampling_frequency_16x_hz', '_error', '_tune_min',
+            '_source', '_next_source', '_shift',
+        )
+
+        # The sequence of the shift register states starting from 1, the position of each state in it and the
+        # number of following shifts that keep the output of each position (built on first use).
+        _shift_sequence = None
+        _shift_positions = None
+        _steady_shift_counts = None
+
+        def __init__(self, master_frequency_hz: int, sampling_frequency_hz: int, limit_frequency_hz: int = None):
+            # Same as _ToneGenerator.
+            limit_frequency_hz = sampling_frequency_hz if limit_frequency_hz is None else limit_frequency_hz
             self._master_frequency_hz = master_frequency_hz
             self._sampling_frequency_16x_hz = sampling_frequency_hz * 16
             self._error = self._master_frequency_hz
             self._tune_min = (
-                self._master_frequency_hz // self._sampling_frequency_16x_hz
+                self._master_frequency_hz // (limit_frequency_hz * 16)
             )
             self._source = (self._tune_min + 1) * self._sampling_frequency_16x_hz
             self._next_source = self._source
@@ -99,7 +300,98 @@ class SampleGenerator:
                 self._source = self._next_source
             return self._shift & 1
 
-    def __init__(self, master_frequency_hz: int = None, sampling_frequency_hz: int = None):
+        def update_edge(self) -> float:
+            # Same as _ToneGenerator.update_edge().
+            self._error -= self._master_frequency_hz
+            if self._error < 0:
+                edge = -self._error / self._master_frequency_hz
+                self._error += self._source
+                self._shift = (
+                    (self._shift >> 1) | ((self._shift ^ (self._shift >> 3)) << 15)
+                ) & 0xFFFF
+                self._source = self._next_source
+                return edge
+            return 0.0
+
+        def steady_count(self) -> int:
+            # Number of upcoming samples without a change of output(). Shifts that keep the output bit are
+            # looked up in the shift table and do not end the span (at most one shift occurs per sample,
+            # see _tune_min).
+            (sequence, positions, steady_shift_counts) = self._shift_table()
+            shift_count = steady_shift_counts[positions[self._shift]]
+            if shift_count == 0:
+                return self._error // self._master_frequency_hz
+            return (
+                self._error + self._source + (shift_count - 1) * self._next_source
+            ) // self._master_frequency_hz
+
+        def advance(self, count: int):
+            # Same as calling update() count times.
+            self._error -= self._master_frequency_hz * count
+            if self._error < 0:
+                self._error += self._source
+                self._source = self._next_source
+                shift_count = 1
+                if self._error < 0:
+                    extra_count = (self._source - 1 - self._error) // self._source
+                    self._error += extra_count * self._source
+                    shift_count += extra_count
+                (sequence, positions, _) = self._shift_table()
+                self._shift = sequence[(positions[self._shift] + shift_count) % len(sequence)]
+
+        def next_changes(self, count: int) -> list[tuple[int, float, bool]]:
+            # Advances count samples and returns the changes of output() as
+            # (sample index, update_edge() of the sample, output after the change).
+            changes = []
+            index = 0
+            while True:
+                span = self.steady_count()
+                if index + span >= count:
+                    self.advance(count - index)
+                    return changes
+                self.advance(span)
+                index += span
+                edge = self.update_edge()
+                changes.append((index, edge, self.output))
+                index += 1
+
+        @classmethod
+        def _shift_table(cls) -> tuple[array, array, array]:
+            if cls._shift_sequence is None:
+                sequence = array('H')
+                positions = array('H', [0]) * 0x10000
+                shift = 1
+                while True:
+                    positions[shift] = len(sequence)
+                    sequence.append(shift)
+                    shift = ((shift >> 1) | ((shift ^ (shift >> 3)) << 15)) & 0xFFFF
+                    if shift == 1:
+                        break
+                # Walk the cycle backwards from the last position before a change of the output.
+                outputs = [shift & 1 for shift in sequence]
+                end = next(
+                    position for position in range(len(sequence) - 1, -1, -1)
+                    if outputs[position] != outputs[position - len(sequence) + 1]
+                )
+                steady_shift_counts = array('H', [0]) * len(sequence)
+                count = 0
+                for position in range(end - 1, end - len(sequence), -1):
+                    count = count + 1 if outputs[position] == outputs[position + 1] else 0
+                    steady_shift_counts[position] = count
+                (cls._shift_sequence, cls._shift_positions, cls._steady_shift_counts) = (
+                    sequence, positions, steady_shift_counts
+                )
+            return (cls._shift_sequence, cls._shift_positions, cls._steady_shift_counts)
+
+        @property
+        def output(self) -> int:
+            return self._shift & 1
+
+    __slots__ = ('_sampling_frequency_hz', '_noise_generator', '_channels', '_band_limited')
+
+    def __init__(
+        self, master_frequency_hz: int = None, sampling_frequency_hz: int = None, band_limited: bool = False
+    ):
         master_frequency_hz = self.DEFAULT_MASTER_FREQUENCY_HZ if master_frequency_hz is None else master_frequency_hz
         sampling_frequency_hz = self.DEFAULT_SAMPLING_FREQUENCY_HZ if sampling_frequency_hz is None else sampling_frequency_hz
         self._sampling_frequency_hz = self.DEFAULT_SAMPLING_FREQUENCY_HZ if sampling_frequency_hz is None else sampling_frequency_hz
@@ -107,7 +399,7 @@ class SampleGenerator:
         self._channels = [
             self.ToneChannel(master_frequency_hz, sampling_frequency_hz) for ch in range(3)
         ]
-        self._mixing_lookup_table = self._MixingLookupTable()
+        self._band_limited = band_limited
 
     def __getitem__(self, channel_number: int) -> ToneChannel:
         return self._channels[channel_number]
@@ -119,7 +411,13 @@ class SampleGenerator:
     def sampling_frequency_hz(self) -> int:
         return self._sampling_frequency_hz
 
+    @property
+    def band_limited(self) -> bool:
+        return self._band_limited
+
     def next_sample(self) -> float:
+        if self._band_limited:
+            return self._next_band_limited_sample()
         is_noise = self._noise_generator.update()
         return sum(
             [
@@ -127,3 +425,191 @@ class SampleGenerator:
                 for channel in self._channels
             ]
         )
+
+    def next_samples(self, count: int) -> list[float]:
+        # Same as [next_sample() for _ in range(count)]. Each channel is rendered in bulk between its edges
+        # (see ToneChannel.next_samples()), so silence and steady tones cost almost nothing.
+        (channel0, channel1, channel2) = self.next_channel_samples(count)
+        return list(map(add, map(add, channel0, channel1), channel2))
+
+    def next_channel_samples(self, count: int) -> list[list[float]]:
+        # Returns count samples of each channel (stems). The sum of the channels is equal to next_samples().
+        noise_generator = self._noise_generator
+        is_noise = noise_generator.output
+        if any(channel.is_noise_on and channel.volume != 0 for channel in self._channels):
+            noise_changes = noise_generator.next_changes(count)
+        else:
+            noise_changes = []
+            noise_generator.advance(count)
+        mixing_lookup_table = self._mixing_lookup_table
+        return [
+            channel.next_samples(
+                count, mixing_lookup_table[channel.volume], is_noise, noise_changes, self._band_limited
+            )
+            for channel in self._channels
+        ]
+
+    def _next_band_limited_sample(self) -> float:
+        return sum(self._next_band_limited_channel_samples())
+
+    def _next_band_limited_channel_samples(self) -> list[float]:
+        is_noise_before = self._noise_generator.output
+        noise_edge = self._noise_generator.update_edge()
+        is_noise = self._noise_generator.output
+        mixing_lookup_table = self._mixing_lookup_table
+        return [
+            channel.mix_with_noise_band_limited(
+                mixing_lookup_table[channel.volume], is_noise_before, is_noise, noise_edge
+            )
+            for channel in self._channels
+        ]
+
+
+class MultiRateSampleGenerator:
+    # Synthesizes once for several sampling rates. The tone and noise edges are computed on the master clock
+    # timeline (one update per master clock) and mixed once, and each rate only fills its samples between the
+    # mixed output changes, so the cost of the edges is shared by all rates.
+    # Tunes are limited as in a SampleGenerator at the highest rate. Compared to a SampleGenerator at the same
+    # rate, register writes take effect on the master clock instead of on a sample of that rate, which can move
+    # an output change by one sample.
+    class _Output:
+        __slots__ = (
+            '_master_frequency_hz', '_sampling_frequency_hz', '_band_limited', '_sample_position', '_output',
+            '_residuals',
+        )
+
+        def __init__(self, master_frequency_hz: int, sampling_frequency_hz: int, band_limited: bool):
+            self._master_frequency_hz = master_frequency_hz
+            self._sampling_frequency_hz = sampling_frequency_hz
+            self._band_limited = band_limited
+            # The next sample. Sample n is the timeline output at master clock ceil(n * master / sampling).
+            self._sample_position = 0
+            # The output of the last sample (band-limited mode).
+            self._output = 0.0
+            # Band-limited residuals of the samples after the last call ({sample position: residual}).
+            self._residuals = {}
+
+        @property
+        def sampling_frequency_hz(self) -> int:
+            return self._sampling_frequency_hz
+
+        def next_samples(
+            self, clock_position: int, changes: list[tuple[int, float]], ends: list[int]
+        ) -> list[float]:
+            # Returns the samples of the master clocks from clock_position, given the changes of the mixed output
+            # as (master clock index, output) starting with the first master clock and the end of each of them.
+            buffer = []
+            sampling_frequency_hz = self._sampling_frequency_hz
+            master_frequency_hz = self._master_frequency_hz
+            sample_position = self._sample_position
+            for ((_, value), end) in zip(changes, ends):
+                # The samples before master clock clock_position + end.
+                next_sample_position = (clock_position + end - 1) * sampling_frequency_hz // master_frequency_hz + 1
+                buffer += [value] * (next_sample_position - sample_position)
+                sample_position = next_sample_position
+            if self._band_limited:
+                buffer = self._band_limit(self._sample_position, clock_position, changes, buffer)
+            self._sample_position = sample_position
+            return buffer
+
+        def _band_limit(
+            self, sample_position: int, clock_position: int, changes: list[tuple[int, float]], buffer: list[float]
+        ) -> list[float]:
+            # Same polyBLEP as SampleGenerator.ToneChannel.mix_with_noise_band_limited(), applied to the steps of
+            # the mixed output (delayed by one sample). Steps at the first master clock come from register writes
+            # and are not band-limited, as in SampleGenerator.
+            if not buffer:
+                return buffer
+            (output, self._output) = (self._output, buffer[-1])
+            buffer = [output] + buffer[:-1]
+            master_frequency_hz = self._master_frequency_hz
+            residuals = self._residuals
+            output = changes[0][1]
+            for (index, value) in changes[1:]:
+                step = value - output
+                output = value
+                # A change at master clock n comes from an edge at master clock n - 1 (see
+                # _ToneGenerator.update_edge()). It appears in the first sample after the edge, which is edge
+                # (0.0 < edge <= 1.0 sample) after it.
+                (edge_position, remain) = divmod(
+                    (clock_position + index - 1) * self._sampling_frequency_hz, master_frequency_hz
+                )
+                edge_position += 1
+                edge = (master_frequency_hz - remain) / master_frequency_hz
+                residuals[edge_position] = residuals.get(edge_position, 0.0) + step * edge * edge * 0.5
+                residuals[edge_position + 1] = (
+                    residuals.get(edge_position + 1, 0.0) - step * (1.0 - edge) * (1.0 - edge) * 0.5
+                )
+            end_position = sample_position + len(buffer)
+            for position in [position for position in residuals if position < end_position]:
+                buffer[position - sample_position] += residuals.pop(position)
+            return buffer
+
+    __slots__ = ('_master_frequency_hz', '_noise_generator', '_channels', '_outputs', '_clock_position')
+
+    def __init__(
+        self, sampling_frequencies_hz: list[int], master_frequency_hz: int = None, band_limited: bool = False
+    ):
+        if not sampling_frequencies_hz:
+            raise ValueError('sampling_frequencies_hz is empty')
+        master_frequency_hz = (
+            SampleGenerator.DEFAULT_MASTER_FREQUENCY_HZ if master_frequency_hz is None else master_frequency_hz
+        )
+        limit_frequency_hz = max(sampling_frequencies_hz)
+        self._master_frequency_hz = master_frequency_hz
+        self._noise_generator = SampleGenerator._NoiseGenerator(
+            master_frequency_hz, master_frequency_hz, limit_frequency_hz
+        )
+        self._channels = [
+            SampleGenerator.ToneChannel(master_frequency_hz, master_frequency_hz, limit_frequency_hz)
+            for ch in range(3)
+        ]
+        self._outputs = [
+            self._Output(master_frequency_hz, sampling_frequency_hz, band_limited)
+            for sampling_frequency_hz in sampling_frequencies_hz
+        ]
+        self._clock_position = 0
+
+    def __getitem__(self, channel_number: int) -> SampleGenerator.ToneChannel:
+        return self._channels[channel_number]
+
+    def set_noise_frequency(self, frequency: int):
+        self._noise_generator.set_frequency(frequency)
+
+    @property
+    def master_frequency_hz(self) -> int:
+        return self._master_frequency_hz
+
+    @property
+    def sampling_frequencies_hz(self) -> list[int]:
+        return [output.sampling_frequency_hz for output in self._outputs]
+
+    def next_samples(self, clock_count: int) -> list[list[float]]:
+        # Advances the timeline by clock_count master clocks and returns the samples of each rate
+        # (in the order of sampling_frequencies_hz) in that time.
+        noise_generator = self._noise_generator
+        is_noise = noise_generator.output
+        if any(channel.is_noise_on and channel.volume != 0 for channel in self._channels):
+            noise_changes = noise_generator.next_changes(clock_count)
+        else:
+            noise_changes = []
+            noise_generator.advance(clock_count)
+        mixing_lookup_table = SampleGenerator._mixing_lookup_table
+        events = sorted(
+            (index, channel_number, value)
+            for (channel_number, channel) in enumerate(self._channels)
+            for (index, value) in channel.next_changes(
+                clock_count, mixing_lookup_table[channel.volume], is_noise, noise_changes
+            )
+        )
+        levels = [0.0] * len(self._channels)
+        changes = []
+        for (index, channel_number, value) in events:
+            levels[channel_number] = value
+            if changes and changes[-1][0] == index:
+                changes.pop()
+            changes.append((index, sum(levels)))
+        ends = [index for (index, _) in changes[1:]] + [clock_count]
+        buffers = [output.next_samples(self._clock_position, changes, ends) for output in self._outputs]
+        self._clock_position += clock_count
+        return buffers